@@ -2,11 +2,25 @@ import os
 import sys
 import re
 import argparse
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from dropbox import Dropbox
-from dropbox.files import FileMetadata, FolderMetadata
+from dropbox import Dropbox, create_session
+from dropbox.files import FileMetadata, DownloadError
 from dropbox.exceptions import *
 
+CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts in seconds for each Dropbox request.
+REQUEST_TIMEOUT = (5, 300)
+# Largest page size files_list_folder accepts.
+LIST_FOLDER_LIMIT = 2000
+
+# os.umask can only be read by setting it, so do it once at import.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -42,7 +56,21 @@ def get_args():
         dest='access_key',
         default=None,
         required=True)
-    return parser.parse_args()
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        default=8,
+        required=False)
+    parser.add_argument(
+        '--skip-auth-check',
+        dest='skip_auth_check',
+        action='store_true',
+        required=False)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    return args
 
 
 def extract_file_name_from_source_full_path(source_full_path):
@@ -59,9 +87,11 @@ def enumerate_destination_file_name(destination_file_name, file_number=1):
     Append a number to the end of the provided destination file name.
     Only used when multiple files are matched to, preventing the destination file from being continuously overwritten.
     """
-    if re.search(r'\.', destination_file_name):
-        destination_file_name = re.sub(
-            r'\.', f'_{file_number}.', destination_file_name, 1)
+    extension_index = destination_file_name.find('.')
+    if extension_index >= 0:
+        destination_file_name = (
+            f'{destination_file_name[:extension_index]}_{file_number}'
+            f'{destination_file_name[extension_index:]}')
     else:
         destination_file_name = f'{destination_file_name}_{file_number}'
     return destination_file_name
@@ -105,7 +135,6 @@ def combine_folder_and_file_name(folder_name, file_name):
     """
     combined_name = os.path.normpath(
         f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
 
     return combined_name
 
@@ -132,36 +161,31 @@ def find_dropbox_file_names(client, prefix=None):
     Fetched all the files in the bucket which are returned in a list as
     file names
     """
-    result = []
-    folders = []
     if prefix and not prefix.startswith('/'):
         prefix = f'/{prefix}'
     try:
-        files = client.files_list_folder(prefix)
+        files = client.files_list_folder(prefix or '', recursive=True,
+                                         limit=LIST_FOLDER_LIMIT)
+        entries = list(files.entries)
+        while files.has_more:
+            files = client.files_list_folder_continue(files.cursor)
+            entries.extend(files.entries)
+    except AuthError as e:
+        print('Failed to authenticate while searching for files')
+        raise(e)
     except Exception as e:
         print(f'Failed to search folder {prefix}')
         return []
 
-    for f in files.entries:
-        if isinstance(f, FileMetadata):
-            result.append(f.path_lower)
-        elif isinstance(f, FolderMetadata):
-            folders.append(f.path_lower)
-    for folder in folders:
-        result.extend(find_dropbox_file_names(client, prefix=folder))
-    return result
+    return [f.path_lower for f in entries if isinstance(f, FileMetadata)]
 
 
 def find_matching_files(file_names, file_name_re):
     """
     Return a list of all file_names that matched the regular expression.
     """
-    matching_file_names = []
-    for file_name in file_names:
-        if re.search(file_name_re, file_name):
-            matching_file_names.append(file_name)
-
-    return matching_file_names
+    return [file_name for file_name in file_names
+            if file_name_re.search(file_name)]
 
 
 def download_dropbox_file(file_name, client, destination_file_name=None):
@@ -170,33 +194,64 @@ def download_dropbox_file(file_name, client, destination_file_name=None):
     the current working directory.
     """
     local_path = os.path.normpath(f'{os.getcwd()}/{destination_file_name}')
+    # Write to a temporary file next to local_path so a failed download
+    # never removes a file another worker has already written there.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(local_path),
+                                     suffix='.part')
 
+    downloaded = False
     try:
-        with open(local_path, 'wb') as f:
-            metadata, _file = client.files_download(path=file_name)
-            f.write(_file.content)
-    except Exception as e:
-        if 'not_found' in str(e):
+        with os.fdopen(fd, 'wb') as f:
+            metadata, response = client.files_download(path=file_name)
+            with response:
+                # Copy straight from the underlying urllib3 response, letting
+                # it undo any Content-Encoding the way iter_content would.
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, f, CHUNK_SIZE)
+        # mkstemp creates the file readable only by its owner; give it the
+        # permissions open() would have.
+        os.chmod(temp_path, FILE_MODE)
+        os.replace(temp_path, local_path)
+        downloaded = True
+    except ApiError as e:
+        lookup_error = None
+        if isinstance(e.error, DownloadError) and e.error.is_path():
+            lookup_error = e.error.get_path()
+        if lookup_error and lookup_error.is_not_found():
             print(f'Download failed. Could not find {file_name}')
-        elif 'not_file' in str(e):
+        elif lookup_error and lookup_error.is_not_file():
             print(f'Download failed. {file_name} is not a file')
         else:
             print(f'Failed to download {file_name} to {local_path}')
-        os.remove(local_path)
         raise(e)
+    except Exception as e:
+        print(f'Failed to download {file_name} to {local_path}')
+        raise(e)
+    finally:
+        if not downloaded and os.path.exists(temp_path):
+            os.remove(temp_path)
 
     print(f'{file_name} successfully downloaded to {local_path}')
 
     return
 
 
-def get_dropbox_client(access_key):
+def get_dropbox_client(access_key, max_connections=8, check_auth=True):
     """
     Attempts to create the Dropbox Client with the associated
+    access key. The connection pool is sized to max_connections so that
+    concurrent workers don't open and discard connections. If check_auth is
+    False the key isn't verified up front, and a bad key surfaces as an
+    AuthError on the first real request instead.
     """
     try:
-        client = Dropbox(access_key)
-        client.users_get_current_account()
+        client = Dropbox(access_key,
+                         session=create_session(
+                             max_connections=max_connections),
+                         user_agent='shipyard/dropbox',
+                         timeout=REQUEST_TIMEOUT)
+        if check_auth:
+            client.users_get_current_account()
         return client
     except AuthError as e:
         print(f'Failed to authenticate using key {access_key}')
@@ -217,7 +272,9 @@ def main():
             (destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    client = get_dropbox_client(access_key=access_key)
+    client = get_dropbox_client(access_key=access_key,
+                                max_connections=args.workers,
+                                check_auth=not args.skip_auth_check)
 
     if source_file_name_match_type == 'regex_match':
         file_names = find_dropbox_file_names(client=client,
@@ -226,6 +283,11 @@ def main():
                                                   re.compile(source_file_name))
         print(f'{len(matching_file_names)} files found. Preparing to download...')
 
+        # Matches that share a basename in different folders map to the same
+        # local file. Keep only the last match in listing order for each
+        # destination, as downloading them one after another would, so the
+        # result doesn't depend on which worker finishes last.
+        downloads = {}
         for index, file_name in enumerate(matching_file_names):
             destination_name = determine_destination_name(
                 destination_folder_name=destination_folder_name,
@@ -234,9 +296,27 @@ def main():
 
             if not file_name.startswith('/'):
                 file_name = f'/{file_name}'
-            print(f'Downloading file {index+1} of {len(matching_file_names)}')
-            download_dropbox_file(file_name=file_name, client=client,
-                                  destination_file_name=destination_name)
+            if destination_name in downloads:
+                print(f'Skipping {downloads[destination_name]}, '
+                      f'{file_name} is also downloaded to {destination_name}')
+                del downloads[destination_name]
+            downloads[destination_name] = file_name
+
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(
+                    download_dropbox_file, file_name=file_name, client=client,
+                    destination_file_name=destination_name)
+                for destination_name, file_name in downloads.items()]
+
+            for index, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                print(f'Downloaded file {index+1} of {len(futures)}')
     else:
         destination_name = determine_destination_name(
             destination_folder_name=destination_folder_name,
@@ -3,13 +3,34 @@ import re
 import json
 import tempfile
 import argparse
-import glob
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from dropbox import Dropbox
-from dropbox.files import UploadSessionCursor, CommitInfo
+from dropbox import Dropbox, create_session
+from dropbox.files import UploadSessionCursor, CommitInfo, UploadSessionType, \
+    UploadSessionFinishArg
 from dropbox.exceptions import *
 
 CHUNK_SIZE = 10 * 1024 * 1024
+# Concurrent upload sessions require every chunk but the last to be a
+# multiple of 4 MiB, and a single request may not exceed 150 MB. 140 MiB is
+# the largest multiple of 4 MiB below 150 MB.
+SESSION_CHUNK_ALIGNMENT = 4 * 1024 * 1024
+MIN_SESSION_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_SESSION_CHUNK_SIZE = 140 * 1024 * 1024
+MAX_SESSION_CHUNKS = 128
+SESSION_WORKERS = 4
+# Upper bound on chunk bytes copied out of source files at once, shared by
+# every large file being uploaded. Must be at least MAX_SESSION_CHUNK_SIZE.
+MAX_IN_FLIGHT_CHUNK_BYTES = 256 * 1024 * 1024
+# Maximum number of entries accepted by files_upload_session_finish_batch_v2.
+BATCH_SIZE = 1000
+# (connect, read) timeouts in seconds for each Dropbox request.
+REQUEST_TIMEOUT = (5, 300)
+
+in_flight_chunk_bytes = 0
+in_flight_chunk_condition = threading.Condition()
 
 
 def get_args():
@@ -45,7 +66,34 @@ def get_args():
         dest='access_key',
         default=None,
         required=True)
-    return parser.parse_args()
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        default=8,
+        required=False)
+    parser.add_argument(
+        '--skip-auth-check',
+        dest='skip_auth_check',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        type=int,
+        default=None,
+        required=False)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.chunk_size is not None and (
+            args.chunk_size <= 0 or
+            args.chunk_size % SESSION_CHUNK_ALIGNMENT or
+            args.chunk_size > MAX_SESSION_CHUNK_SIZE):
+        parser.error(f'--chunk-size must be a multiple of '
+                     f'{SESSION_CHUNK_ALIGNMENT} bytes, no larger than '
+                     f'{MAX_SESSION_CHUNK_SIZE} bytes')
+    return args
 
 
 def extract_file_name_from_source_full_path(source_full_path):
@@ -63,9 +111,11 @@ def enumerate_destination_file_name(destination_file_name, file_number=1):
     Only used when multiple files are matched to, preventing the destination
     file from being continuously overwritten.
     """
-    if re.search(r'\.', destination_file_name):
-        destination_file_name = re.sub(
-            r'\.', f'_{file_number}.', destination_file_name, 1)
+    extension_index = destination_file_name.find('.')
+    if extension_index >= 0:
+        destination_file_name = (
+            f'{destination_file_name[:extension_index]}_{file_number}'
+            f'{destination_file_name[extension_index:]}')
     else:
         destination_file_name = f'{destination_file_name}_{file_number}'
     return destination_file_name
@@ -112,7 +162,6 @@ def combine_folder_and_file_name(folder_name, file_name):
     """
     combined_name = os.path.normpath(
         f'{folder_name}{"/" if folder_name else ""}{file_name}')
-    combined_name = os.path.normpath(combined_name)
 
     return combined_name
 
@@ -140,27 +189,42 @@ def find_all_local_file_names(source_folder_name):
     filtered by source_folder_name if provided.
     """
     cwd = os.getcwd()
-    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}/**')
-    file_names = glob.glob(cwd_extension, recursive=True)
-    return [file_name for file_name in file_names if os.path.isfile(file_name)]
+    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}')
+    return list(iterate_local_file_names(cwd_extension))
+
+
+def iterate_local_file_names(folder_name):
+    """
+    Recursively yields every non-hidden file beneath folder_name, matching
+    the results of a recursive '**' glob. Uses os.scandir so each entry's
+    type comes from the directory listing rather than a separate stat call.
+    """
+    try:
+        with os.scandir(folder_name) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            yield from iterate_local_file_names(entry.path)
+        elif entry.is_file():
+            yield entry.path
 
 
 def find_all_file_matches(file_names, file_name_re):
     """
     Return a list of all file_names that matched the regular expression.
     """
-    matching_file_names = []
-    for file in file_names:
-        if re.search(file_name_re, file):
-            matching_file_names.append(file)
-
-    return matching_file_names
+    return [file for file in file_names if file_name_re.search(file)]
 
 
 def upload_dropbox_file(
         client,
         source_full_path,
-        destination_full_path):
+        destination_full_path,
+        chunk_size=None):
     """
     Uploads a single file to Dropbox.
     """
@@ -171,7 +235,8 @@ def upload_dropbox_file(
     else:
         upload_large_dropbox_file(client=client,
                                   source_full_path=source_full_path,
-                                  destination_full_path=destination_full_path)
+                                  destination_full_path=destination_full_path,
+                                  chunk_size=chunk_size)
 
 
 def upload_small_dropbox_file(
@@ -191,33 +256,171 @@ def upload_small_dropbox_file(
           f'{destination_full_path}')
 
 
-def upload_large_dropbox_file(
+def start_small_dropbox_file_session(
         client,
         source_full_path,
         destination_full_path):
     """
-    Uploads a large (>CHUNK_SIZE) single file to Dropbox.
+    Sends a small (<=CHUNK_SIZE) file to Dropbox in a single closed upload
+    session and returns the entry needed to commit it in a batch.
     """
-    file_size = os.path.getsize(source_full_path)
     with open(source_full_path, 'rb') as f:
+        data = f.read(CHUNK_SIZE)
+    upload_session_start_result = client.files_upload_session_start(
+        data, close=True)
+    cursor = UploadSessionCursor(
+        session_id=upload_session_start_result.session_id, offset=len(data))
+    commit = CommitInfo(path=destination_full_path)
+    return UploadSessionFinishArg(cursor=cursor, commit=commit)
+
+
+def upload_small_dropbox_files(client, file_paths, workers):
+    """
+    Uploads many small (<=CHUNK_SIZE) files to Dropbox. The file contents are
+    sent in parallel, then committed BATCH_SIZE files at a time.
+    file_paths is a list of (source_full_path, destination_full_path) pairs.
+    """
+    for batch_start in range(0, len(file_paths), BATCH_SIZE):
+        batch = file_paths[batch_start:batch_start + BATCH_SIZE]
+        entries = []
+        uploaded_paths = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    start_small_dropbox_file_session,
+                    client=client,
+                    source_full_path=source_full_path,
+                    destination_full_path=destination_full_path):
+                (source_full_path, destination_full_path)
+                for source_full_path, destination_full_path in batch}
+
+            for future in as_completed(futures):
+                source_full_path, destination_full_path = futures[future]
+                try:
+                    entries.append(future.result())
+                    uploaded_paths.append(
+                        (source_full_path, destination_full_path))
+                except ApiError as e:
+                    print(f'Failed to upload file {source_full_path}')
+                except Exception:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+        if not entries:
+            continue
+
+        try:
+            result = client.files_upload_session_finish_batch_v2(entries)
+        except ApiError as e:
+            print(f'Failed to commit {len(entries)} uploaded files')
+            continue
+
+        for entry, (source_full_path, destination_full_path) in zip(
+                result.entries, uploaded_paths):
+            if entry.is_success():
+                print(f'{source_full_path} successfully uploaded to '
+                      f'{destination_full_path}')
+            else:
+                print(f'Failed to upload file {source_full_path}')
+
+
+def upload_dropbox_file_chunk(
+        client,
+        source_mmap,
+        session_id,
+        offset,
+        length,
+        close=False):
+    """
+    Appends length bytes of source_mmap, starting at offset, to a concurrent
+    upload session. Waits until the chunk fits within
+    MAX_IN_FLIGHT_CHUNK_BYTES before copying it out of source_mmap.
+    """
+    global in_flight_chunk_bytes
+    with in_flight_chunk_condition:
+        in_flight_chunk_condition.wait_for(
+            lambda: in_flight_chunk_bytes + length <=
+            MAX_IN_FLIGHT_CHUNK_BYTES)
+        in_flight_chunk_bytes += length
+
+    try:
+        cursor = UploadSessionCursor(session_id=session_id, offset=offset)
+        client.files_upload_session_append_v2(
+            source_mmap[offset:offset + length], cursor, close=close)
+    finally:
+        with in_flight_chunk_condition:
+            in_flight_chunk_bytes -= length
+            in_flight_chunk_condition.notify_all()
+
+
+def determine_session_chunk_size(file_size):
+    """
+    Pick an upload session chunk size that keeps large files to at most
+    MAX_SESSION_CHUNKS requests, rounded up to SESSION_CHUNK_ALIGNMENT and
+    kept between MIN_SESSION_CHUNK_SIZE and MAX_SESSION_CHUNK_SIZE.
+    """
+    chunk_size = -(-file_size // MAX_SESSION_CHUNKS)
+    chunk_size = -(-chunk_size // SESSION_CHUNK_ALIGNMENT) * \
+        SESSION_CHUNK_ALIGNMENT
+    return min(MAX_SESSION_CHUNK_SIZE,
+               max(MIN_SESSION_CHUNK_SIZE, chunk_size))
+
+
+def upload_large_dropbox_file(
+        client,
+        source_full_path,
+        destination_full_path,
+        chunk_size=None):
+    """
+    Uploads a large (>CHUNK_SIZE) single file to Dropbox, sending the chunks
+    of a concurrent upload session in parallel. chunk_size must be a multiple
+    of SESSION_CHUNK_ALIGNMENT; it is derived from the file size if not
+    provided. However many files upload at once, at most
+    MAX_IN_FLIGHT_CHUNK_BYTES of chunk data is held in memory.
+    """
+    file_size = os.path.getsize(source_full_path)
+    if not chunk_size:
+        chunk_size = determine_session_chunk_size(file_size)
+    with open(source_full_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
         try:
             upload_session_start_result = client.files_upload_session_start(
-                f.read(CHUNK_SIZE))
+                b'', session_type=UploadSessionType.concurrent)
             session_id = upload_session_start_result.session_id
+            last_offset = (file_size - 1) // chunk_size * chunk_size
+
+            with ThreadPoolExecutor(max_workers=SESSION_WORKERS) as executor:
+                futures = [
+                    executor.submit(
+                        upload_dropbox_file_chunk,
+                        client=client,
+                        source_mmap=mm,
+                        session_id=session_id,
+                        offset=offset,
+                        length=chunk_size)
+                    for offset in range(0, last_offset, chunk_size)]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+
+            # The closing append carries the remainder and must only be sent
+            # once every other chunk has landed.
+            upload_dropbox_file_chunk(client=client,
+                                      source_mmap=mm,
+                                      session_id=session_id,
+                                      offset=last_offset,
+                                      length=file_size - last_offset,
+                                      close=True)
             cursor = UploadSessionCursor(
-                session_id=session_id, offset=f.tell())
+                session_id=session_id, offset=file_size)
             commit = CommitInfo(path=destination_full_path)
-
-            while f.tell() < file_size:
-                if ((file_size - f.tell()) <= CHUNK_SIZE):
-                    print(
-                        client.files_upload_session_finish(
-                            f.read(CHUNK_SIZE), cursor, commit))
-                else:
-                    client.files_upload_session_append(f.read(CHUNK_SIZE),
-                                                       cursor.session_id,
-                                                       cursor.offset)
-                    cursor.offset = f.tell()
+            print(client.files_upload_session_finish(b'', cursor, commit))
         except ApiError as e:
             print(f'Failed to upload file {source_full_path}')
 
@@ -225,13 +428,22 @@ def upload_large_dropbox_file(
           f'{destination_full_path}')
 
 
-def get_dropbox_client(access_key):
+def get_dropbox_client(access_key, max_connections=8, check_auth=True):
     """
     Attempts to create the Dropbox Client with the associated
+    access key. The connection pool is sized to max_connections so that
+    concurrent workers don't open and discard connections. If check_auth is
+    False the key isn't verified up front, and a bad key surfaces as an
+    AuthError on the first real request instead.
     """
     try:
-        client = Dropbox(access_key)
-        client.users_get_current_account()
+        client = Dropbox(access_key,
+                         session=create_session(
+                             max_connections=max_connections),
+                         user_agent='shipyard/dropbox',
+                         timeout=REQUEST_TIMEOUT)
+        if check_auth:
+            client.users_get_current_account()
         return client
     except AuthError as e:
         print(f'Failed to authenticate using key {access_key}')
@@ -249,7 +461,9 @@ def main():
     destination_folder_name = clean_folder_name(args.destination_folder_name)
     source_file_name_match_type = args.source_file_name_match_type
 
-    client = get_dropbox_client(access_key=access_key)
+    client = get_dropbox_client(access_key=access_key,
+                                max_connections=args.workers * SESSION_WORKERS,
+                                check_auth=not args.skip_auth_check)
 
     if source_file_name_match_type == 'regex_match':
         file_names = find_all_local_file_names(source_folder_name)
@@ -257,17 +471,48 @@ def main():
             file_names, re.compile(source_file_name))
         print(f'{len(matching_file_names)} files found. Preparing to upload...')
 
+        # Matches that share a basename in different local folders map to the
+        # same Dropbox path, which is case-insensitive. Only the first match
+        # in walk order would have been committed when uploading one after
+        # another, so keep that one and skip the rest.
+        uploads = {}
         for index, key_name in enumerate(matching_file_names):
             destination_full_path = determine_destination_full_path(
                 destination_folder_name=destination_folder_name,
                 destination_file_name=args.destination_file_name,
                 source_full_path=key_name,
                 file_number=index + 1)
-            print(f'Uploading file {index+1} of {len(matching_file_names)}')
-            upload_dropbox_file(
-                source_full_path=key_name,
-                destination_full_path=destination_full_path,
-                client=client)
+            destination_key = destination_full_path.lower()
+            if destination_key in uploads:
+                print(f'Skipping {key_name}, {uploads[destination_key][0]} '
+                      f'is also uploaded to {destination_full_path}')
+                continue
+            uploads[destination_key] = (key_name, destination_full_path)
+        file_paths = list(uploads.values())
+
+        if all(os.path.getsize(key_name) <= CHUNK_SIZE
+               for key_name, destination_full_path in file_paths):
+            upload_small_dropbox_files(client=client, file_paths=file_paths,
+                                       workers=args.workers)
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                futures = [
+                    executor.submit(
+                        upload_dropbox_file,
+                        source_full_path=key_name,
+                        destination_full_path=destination_full_path,
+                        client=client,
+                        chunk_size=args.chunk_size)
+                    for key_name, destination_full_path in file_paths]
+
+                for index, future in enumerate(as_completed(futures)):
+                    try:
+                        future.result()
+                    except Exception:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+                    print(f'Uploaded file {index+1} of {len(file_paths)}')
 
     else:
         destination_full_path = determine_destination_full_path(
@@ -277,7 +522,8 @@ def main():
         upload_dropbox_file(
             source_full_path=source_full_path,
             destination_full_path=destination_full_path,
-            client=client)
+            client=client,
+            chunk_size=args.chunk_size)
 
 
 if __name__ == '__main__':